@@ -4,6 +4,9 @@
 use wasm_bindgen::prelude::*;
 // serdeクレートから、Rustのデータ構造とJSONのようなシリアライズ可能な形式との間で相互変換を行うためのSerializeとDeserializeトレイトをインポート
 use serde::{Deserialize, Serialize};
+use std::cell::RefCell;
+use std::cmp::Reverse;
+use std::collections::{BinaryHeap, HashMap, HashSet, VecDeque};
 
 /// WASM実行中にRustコードがパニック（回復不能なエラー）を起こした際に、ブラウザの開発者コンソールに詳細なエラー情報を出力するためのフックを設定
 #[cfg(feature = "console_error_panic_hook")]
@@ -95,174 +98,886 @@ pub struct SolveResult {
     error: bool,               // エラーが発生したかどうかを示すフラグ
 }
 
+/// 解析対象のライン（行または列）を表すenum
+#[derive(Clone, Copy, Debug, PartialEq, Eq, PartialOrd, Ord)]
+enum Line {
+    Row(usize),
+    Col(usize),
+}
+
 // --- コアロジック関数 ---
 
-/// 1行または1列（ライン）を解析し、確定できるマスを導き出す関数
+/// 1ラインの状態をビットマスクで表すための型
+/// i番目のビットがラインのi番目のマスに対応するため、ラインの長さは最大128マスまで
+type LineMask = u128;
+
+/// ビットマスクで扱えるラインの最大長
+const MAX_LINE_SIZE: usize = LineMask::BITS as usize;
+
+/// 仮置きにかける手間の上限（仮置き中に行うラインの解析の回数）
+/// 大きな盤面で仮置きが長引いて画面が固まらないよう、上限に達したらそれまでに確定したマスで打ち切る
+const PROBE_LINE_BUDGET: usize = 50_000;
+
+/// 確定したマスの状態を、「塗り」のマスクの`i`番目のビットから求める
+fn cell_state_at(filled: LineMask, i: usize) -> CellState {
+    if filled & (1 << i) != 0 {
+        CellState::Filled
+    } else {
+        CellState::Crossed
+    }
+}
+
+/// 長さ`line_size`のライン全体を表すマスク（下位`line_size`ビットが全て1）を返す
+fn full_line_mask(line_size: usize) -> LineMask {
+    if line_size == MAX_LINE_SIZE {
+        LineMask::MAX
+    } else {
+        (1 << line_size) - 1
+    }
+}
+
+/// ラインの候補となる配置パターンの、全ラインで共有する配列(`patterns`)の中での範囲
+/// ラインごとに配列を持つ代わりに1つの連続した配列にまとめておくことで、メモリ確保の回数を減らす
+/// 矛盾したパターンは捨てずに範囲の後ろへ寄せ、先頭の`live`個だけを有効な候補として扱う
+/// これにより、仮置きを取り消す際は`live`を元に戻すだけで候補を復元できる
+struct Candidates {
+    start: usize,
+    len: usize,
+    live: usize,
+}
+
+/// ビットマスクで表したラインを解析し、確定できるマスを導き出すカーネル関数
 ///
 /// # Arguments
-/// * `line_size` - 解析対象ラインの長さ（列数または行数）
-/// * `rule` - そのラインに適用されるルール（例: `[2, 1]`）
-/// * `user_line` - 現在のラインの状態（ユーザーの入力や前回の解析結果を含む）
+/// * `line_filled` - 現在のラインで「塗り」が確定しているマスのマスク
+/// * `line_known` - 現在のラインで状態が確定しているマスのマスク
+/// * `full_mask` - ライン全体を表すマスク
+/// * `candidates` - そのラインでまだ矛盾していない配置パターンの範囲（矛盾したパターンは有効な候補から外される）
+/// * `patterns` - 全ラインの配置パターンをまとめた配列
 ///
 /// # Returns
-/// * `Ok(Vec<CellState>)` - 更新されたラインの状態
-/// * `Err(String)` - 矛盾などが発生した場合のエラーメッセージ
-fn solve_line(
-    line_size: usize,
-    rule: &[usize],
-    user_line: &[CellState],
-) -> Result<Vec<CellState>, String> {
-    // ルールが空、または[0]のみの場合、そのラインは全て「×」(Crossed)で確定
-    if rule.is_empty() || (rule.len() == 1 && rule[0] == 0) {
-        let mut new_line = user_line.to_vec();
-        for i in 0..line_size {
-            // もし既に「塗り」のマスがあれば、ルールと矛盾するのでエラー
-            if user_line[i] == CellState::Filled {
-                return Err("入力に矛盾があります".to_string());
-            }
-            new_line[i] = CellState::Crossed;
+/// * `Some((filled, known))` - 解析後の「塗り」のマスクと確定済みのマスク
+/// * `None` - 矛盾しないパターンが一つもない場合
+fn solve_line_masks(
+    line_filled: LineMask,
+    line_known: LineMask,
+    full_mask: LineMask,
+    candidates: &mut Candidates,
+    patterns: &mut [LineMask],
+) -> Option<(LineMask, LineMask)> {
+    let patterns = &mut patterns[candidates.start..candidates.start + candidates.live];
+    // 確定済みのマスで「塗り」の有無が一致しないパターンは、以後も矛盾したままなので候補から取り除く
+    // 絞り込みと同時に、残ったパターンの論理積（全パターンで「塗り」のマス）と
+    // 論理和（いずれかのパターンで「塗り」のマス）を求めておき、候補を二度走査せずに済ませる
+    let mut must_be_filled = full_mask;
+    let mut may_be_filled: LineMask = 0;
+    // 残ったパターンは有効な候補の先頭へ順に詰めていく
+    let mut live = 0;
+    for i in 0..patterns.len() {
+        let p = patterns[i];
+        if (p ^ line_filled) & line_known != 0 {
+            continue;
         }
-        return Ok(new_line);
+        must_be_filled &= p;
+        may_be_filled |= p;
+        patterns.swap(live, i);
+        live += 1;
     }
+    candidates.live = live;
 
-    // 1. ルールに合致する全ての可能性のある配置パターンを生成する
-    let possibilities = generate_possibilities(line_size, rule);
+    // 矛盾しないパターンが一つもなければ、入力に矛盾があるということ
+    if live == 0 {
+        return None;
+    }
 
-    // 2. 生成された全パターンの中から、現在のラインの状態(`user_line`)と矛盾しないものだけを絞り込む
-    let valid_possibilities: Vec<_> = possibilities
-        .into_iter()
-        .filter(|p| {
-            // p は一つの可能性パターン (例: [1, 1, 0, 1, 0])
-            (0..line_size).all(|i| match user_line[i] {
-                // 既に「塗り」のマスは、パターンでも「塗り」(1)でなければならない
-                CellState::Filled => p[i] == 1,
-                // 既に「×」のマスは、パターンでも「空」(0)でなければならない
-                CellState::Crossed => p[i] == 0,
-                // 「空」のマスはどんなパターンでもOK
-                CellState::Empty => true,
-            })
-        })
-        .collect();
+    // どのパターンでも「塗り」にならないマスは「×」で確定する
+    Some((
+        line_filled | must_be_filled,
+        line_known | must_be_filled | (full_mask & !may_be_filled),
+    ))
+}
 
-    // 矛盾しないパターンが一つもなければ、入力に矛盾があるということ
-    if valid_possibilities.is_empty() {
-        return Err("入力に矛盾があります".to_string());
+/// ラインの`[from, to)`の範囲のマスを表すマスクを返す
+fn range_mask(from: usize, to: usize) -> LineMask {
+    full_line_mask(to) & !full_line_mask(from)
+}
+
+/// ラインの左右を反転したマスクを返す（`i`番目のマスが`line_size - 1 - i`番目に移る）
+fn reverse_mask(mask: LineMask, line_size: usize) -> LineMask {
+    if line_size == 0 {
+        0
+    } else {
+        mask.reverse_bits() >> (MAX_LINE_SIZE - line_size)
     }
+}
 
-    // 3. 矛盾しない全パターンで共通しているマスを特定する
-    let mut new_line = user_line.to_vec();
-    for i in 0..line_size {
-        // 既に確定しているマスはスキップ
-        if new_line[i] != CellState::Empty {
-            continue;
+/// ルールとラインの長さだけから決まる、各ブロックの置き方の情報
+/// ラインを解析するたびに同じ計算を繰り返さないよう、ラインごとに一度だけ求めておく
+struct BlockLayout {
+    /// 各ブロックの長さ
+    lengths: Vec<usize>,
+    /// 各ブロックを左端に置いたときのマスク（`start`からの配置は`start`だけシフトして求める）
+    masks: Vec<LineMask>,
+    /// 確定済みのマスを考えないときの、各ブロックの最も左の開始位置
+    earliest_starts: Vec<usize>,
+    /// 確定済みのマスを考えないときの、各ブロックの最も右の開始位置
+    latest_starts: Vec<usize>,
+    /// 全てのブロックを1マスずつ空けて並べるのに必要な長さ（ラインの長さを超えるルールは配置できない）
+    min_length: usize,
+}
+
+impl BlockLayout {
+    /// 長さ`line_size`のラインについて、各ブロックの置き方の情報を求める
+    fn new(line_size: usize, lengths: Vec<usize>) -> Self {
+        let masks = lengths
+            .iter()
+            .map(|&length| range_mask(0, length.min(line_size)))
+            .collect();
+        let mut earliest_starts = Vec::with_capacity(lengths.len());
+        let mut start = 0;
+        for &length in &lengths {
+            earliest_starts.push(start);
+            start += length + 1;
+        }
+        let mut latest_starts = vec![0; lengths.len()];
+        let mut end = line_size + 1;
+        for (block_index, &length) in lengths.iter().enumerate().rev() {
+            latest_starts[block_index] = end.saturating_sub(length + 1);
+            end = latest_starts[block_index];
+        }
+        BlockLayout {
+            min_length: start.saturating_sub(1),
+            lengths,
+            masks,
+            earliest_starts,
+            latest_starts,
         }
+    }
+}
 
-        // 最初の有効なパターンのi番目の状態を取得
-        let first_state = valid_possibilities[0][i];
-        // 全ての有効なパターンで、i番目の状態が `first_state` と同じかチェック
-        if valid_possibilities.iter().all(|p| p[i] == first_state) {
-            // 全て同じであれば、そのマスは確定できる
-            new_line[i] = if first_state == 1 {
-                CellState::Filled // 全て1なら「塗り」
-            } else {
-                CellState::Crossed // 全て0なら「×」
-            };
+/// 各ブロックを、確定済みのマスと矛盾しない範囲で最も左に詰めて配置したときの開始位置を求める関数
+///
+/// # Arguments
+/// * `line_size` - ラインの長さ
+/// * `layout` - 適用するルールから求めた、各ブロックの置き方の情報
+/// * `line_filled` - 「塗り」が確定しているマスのマスク
+/// * `line_crossed` - 「×」が確定しているマスのマスク
+///
+/// # Returns
+/// * `Some(Vec<usize>)` - 各ブロックの開始位置
+/// * `None` - 確定済みのマスと矛盾しない配置が存在しない場合
+fn leftmost_starts(
+    line_size: usize,
+    layout: &BlockLayout,
+    line_filled: LineMask,
+    line_crossed: LineMask,
+) -> Option<Vec<usize>> {
+    if layout.min_length > line_size {
+        return None;
+    }
+    let block_count = layout.lengths.len();
+
+    // `block_index`番目のブロックを`start`から置けるなら、次のブロックを置き始められる位置を返す
+    // ブロックの範囲に「×」がなく、ブロックの直後のマスが「塗り」でなければ置ける
+    // `start`は常にそのブロックの最も右の開始位置以下なので、ブロックがラインからはみ出すことはない
+    let place = |block_index: usize, start: usize| -> Option<usize> {
+        let end = start + layout.lengths[block_index];
+        if line_crossed & (layout.masks[block_index] << start) != 0 {
+            None
+        } else if end == line_size {
+            Some(line_size)
+        } else if line_filled & (1 << end) != 0 {
+            None
+        } else {
+            Some(end + 1)
+        }
+    };
+
+    // `fits[b * width + i]`: `i`番目以降のマスに、`b`番目以降のブロックを全て配置できるかどうか
+    // 右端から順に求めておくことで、左に詰める際に後続のブロックが置けなくなる配置を避けられる
+    // 各ブロックは最も左と最も右の開始位置の間にしか置けないので、その範囲だけを求める（範囲外は常に`false`）
+    let width = line_size + 1;
+    let mut fits = vec![false; (block_count + 1) * width];
+    for i in 0..=line_size {
+        fits[block_count * width + i] = line_filled & range_mask(i, line_size) == 0;
+    }
+    for block_index in (0..block_count).rev() {
+        let (earliest, latest) = (
+            layout.earliest_starts[block_index],
+            layout.latest_starts[block_index],
+        );
+        for i in (earliest..=latest).rev() {
+            // `i`番目のマスを空けて次のマスから配置するか、`i`番目のマスからブロックを配置する
+            let skip = line_filled & (1 << i) == 0 && fits[block_index * width + i + 1];
+            let placed =
+                place(block_index, i).is_some_and(|next| fits[(block_index + 1) * width + next]);
+            fits[block_index * width + i] = skip || placed;
+        }
+    }
+    if !fits[0] {
+        return None;
+    }
+
+    // 先頭のブロックから順に、後続のブロックを全て配置できる最も左の位置に置いていく
+    let mut starts = Vec::with_capacity(block_count);
+    let mut i = 0;
+    for block_index in 0..block_count {
+        let mut start = i;
+        loop {
+            if let Some(next) = place(block_index, start)
+                && fits[(block_index + 1) * width + next]
+            {
+                starts.push(start);
+                i = next;
+                break;
+            }
+            start += 1;
         }
     }
+    Some(starts)
+}
 
-    // 更新されたラインを返す
-    Ok(new_line)
+/// ルールから求められる、解析中に変わらないラインごとの情報
+/// ラインを解析するたびに計算し直さずに済むよう、`solve_puzzle`の最初に一度だけ求めておく
+struct LineInfo<'a> {
+    /// ラインの長さ
+    line_size: usize,
+    /// ライン全体を表すマスク
+    full_mask: LineMask,
+    /// 適用するルール（[0]のみのルールは、同じく全て「×」となる空のルールにそろえる）
+    rule: &'a [usize],
+    /// ルールから求めた各ブロックの置き方の情報（左端に詰めた配置を求める際に使う）
+    layout: BlockLayout,
+    /// 左右を反転したルールから求めた各ブロックの置き方の情報（右端に詰めた配置を求める際に使う）
+    reversed_layout: BlockLayout,
+    /// ルールだけで全てのマスが決まるラインの場合は、その唯一の配置
+    /// ルールが空のライン（全て「×」）と、ブロックが1マスずつの間隔でちょうど収まるラインが該当する
+    forced: Option<LineMask>,
 }
 
-/// ルールに基づいて、考えられる全ての「塗り」の配置パターンを生成する再帰関数
+impl<'a> LineInfo<'a> {
+    fn new(line_size: usize, rule: &'a [usize]) -> Self {
+        let rule = if rule == [0] { &[][..] } else { rule };
+        let layout = BlockLayout::new(line_size, rule.to_vec());
+        let forced = if rule.is_empty() {
+            Some(0)
+        } else if layout.min_length == line_size {
+            // 左端から順に、ブロックを1マスずつ空けて並べた配置
+            let mut start = 0;
+            let mut pattern: LineMask = 0;
+            for &block_length in rule {
+                pattern |= range_mask(start, start + block_length);
+                start += block_length + 1;
+            }
+            Some(pattern)
+        } else {
+            None
+        };
+        LineInfo {
+            line_size,
+            full_mask: full_line_mask(line_size),
+            rule,
+            layout,
+            reversed_layout: BlockLayout::new(line_size, rule.iter().rev().copied().collect()),
+            forced,
+        }
+    }
+}
+
+/// 各ブロックを左端に詰めた配置と右端に詰めた配置を比較し、配置パターンを列挙せずに確定できるマスを導き出す関数
+/// 各ブロックは必ず2つの配置の間に収まるので、左詰めと右詰めで重なる範囲は「塗り」、
+/// どのブロックの範囲にも含まれないマスは「×」で確定する
 ///
 /// # Arguments
-/// * `size` - ラインの長さ
-/// * `rule` - 適用するルール
+/// * `info` - 解析対象ラインの長さやルール
+/// * `line_filled` - 現在のラインで「塗り」が確定しているマスのマスク
+/// * `line_known` - 現在のラインで状態が確定しているマスのマスク
 ///
 /// # Returns
-/// * `Vec<Vec<u8>>` - 考えられる全てのパターン（`1`が塗り、`0`が空）のリスト
-fn generate_possibilities(size: usize, rule: &[usize]) -> Vec<Vec<u8>> {
-    let mut solutions = Vec::new();
-    let mut current_arrangement = vec![0; size];
-
-    // 再帰的に探索を行う内部関数
-    fn recurse(
-        size: usize,
-        rule: &[usize],
-        block_index: usize, // 現在配置しようとしているルールのインデックス
-        start_index: usize, // 現在のブロックを配置し始めることができる、最小のインデックス
-        current_arrangement: &mut Vec<u8>, // 現在の配置状態
-        solutions: &mut Vec<Vec<u8>>, // 完成したパターンの保存場所
-    ) {
-        // ベースケース: 全てのルールブロックを配置し終えたら、現在の配置を解として保存
-        if block_index == rule.len() {
-            solutions.push(current_arrangement.clone());
+/// * `Some((filled, known))` - 解析後の「塗り」のマスクと確定済みのマスク
+/// * `None` - 確定済みのマスと矛盾しない配置が存在しない場合
+fn push_line(
+    info: &LineInfo,
+    line_filled: LineMask,
+    line_known: LineMask,
+) -> Option<(LineMask, LineMask)> {
+    let (line_size, rule) = (info.line_size, info.rule);
+    let line_crossed = line_known & !line_filled;
+
+    let left_starts = leftmost_starts(line_size, &info.layout, line_filled, line_crossed)?;
+    // 右端に詰めた配置は、ラインとルールを左右反転して左に詰めた配置から求める
+    let reversed_starts = leftmost_starts(
+        line_size,
+        &info.reversed_layout,
+        reverse_mask(line_filled, line_size),
+        reverse_mask(line_crossed, line_size),
+    )?;
+
+    let mut must_be_filled: LineMask = 0;
+    let mut may_be_filled: LineMask = 0;
+    for (block_index, &block_length) in rule.iter().enumerate() {
+        let left_start = left_starts[block_index];
+        let right_start = line_size - reversed_starts[rule.len() - 1 - block_index] - block_length;
+        if right_start < left_start + block_length {
+            must_be_filled |= range_mask(right_start, left_start + block_length);
+        }
+        may_be_filled |= range_mask(left_start, right_start + block_length);
+    }
+    Some((
+        line_filled | must_be_filled,
+        line_known | must_be_filled | (info.full_mask & !may_be_filled),
+    ))
+}
+
+/// 1行または1列（ライン）を解析し、確定できるマスを導き出す関数
+/// まず左詰めと右詰めの比較(`push_line`)を行い、それで何も確定しなかった場合にだけ、
+/// 配置パターンを列挙する解析(`solve_line_masks`)に切り替える
+///
+/// # Arguments
+/// * `cache` - 解析対象ラインと同じ長さのラインで共有する、配置パターンのキャッシュ
+/// * `info` - 解析対象ラインの長さやルール（例: `[2, 1]`）
+/// * `candidates` - そのラインでまだ矛盾していない配置パターンの範囲（初めて列挙が必要になったときにキャッシュから取り出す）
+/// * `patterns` - 全ラインの配置パターンをまとめた配列
+/// * `line_filled` - 現在のラインで「塗り」が確定しているマスのマスク
+/// * `line_known` - 現在のラインで状態が確定しているマスのマスク
+///
+/// # Returns
+/// * `Some((filled, known, revisit))` - 解析後の「塗り」のマスクと確定済みのマスク、そのラインを再解析する必要があるかどうか
+/// * `None` - 確定済みのマスと矛盾しない配置が存在しない場合
+fn solve_line<'a>(
+    cache: &PossibilityCache<'a>,
+    info: &LineInfo<'a>,
+    candidates: &mut Option<Candidates>,
+    patterns: &mut Vec<LineMask>,
+    line_filled: LineMask,
+    line_known: LineMask,
+) -> Option<(LineMask, LineMask, bool)> {
+    let full_mask = info.full_mask;
+    let (mut new_filled, mut new_known) = push_line(info, line_filled, line_known)?;
+
+    // 左詰めと右詰めの比較でマスが確定した場合、列挙はせずに、もう一度このラインを解析する
+    // 全てのマスが確定していれば、それ以上解析する必要はない
+    let revisit = new_known != line_known && new_known != full_mask;
+
+    // 確定済みのマスが一つもないラインでは、左詰めと右詰めの比較で確定するマスが全パターンの共通部分と一致する
+    // 全てのマスが確定済みのラインも、左詰めが見つかった時点でルールと一致していることが分かっている
+    // どちらも列挙しても何も得られないので、配置パターンを生成せずに済ませる
+    if new_known == line_known && line_known != 0 && line_known != full_mask {
+        let candidates = candidates.get_or_insert_with(|| cache.append_to(info.rule, patterns));
+        (new_filled, new_known) =
+            solve_line_masks(line_filled, line_known, full_mask, candidates, patterns)?;
+    }
+    Some((new_filled, new_known, revisit))
+}
+
+/// ルールに基づいて、考えられる全ての「塗り」の配置パターンを生成する関数
+/// 再帰呼び出しの代わりに、配置済みブロックの開始位置を積んだスタックを使って探索する
+/// 生成したパターンは一時的な配列を介さず、`solutions`の末尾に直接追加する
+///
+/// # Arguments
+/// * `size` - ラインの長さ
+/// * `rule` - 適用するルール
+/// * `solutions` - 考えられる全てのパターン（立っているビットが塗り）を追加する配列
+fn generate_possibilities(size: usize, rule: &[usize], solutions: &mut Vec<LineMask>) {
+    // ルールが空または[0]の場合、すべて0のパターンのみが解となる
+    if rule.is_empty() || (rule.len() == 1 && rule[0] == 0) {
+        solutions.push(0);
+        return;
+    }
+
+    // 各ブロックを配置できる、最も遅い（右側の）開始位置を求める
+    // 後に続くブロックが必要とする最小スペース（ブロック長 + 区切りの1マス）を右端から積み上げていく
+    // ルールがラインに収まらない場合は、配置パターンは一つもない
+    let mut latest_starts = vec![0; rule.len()];
+    let mut space_for_remaining = 0;
+    for block_index in (0..rule.len()).rev() {
+        let Some(latest_start) = size.checked_sub(space_for_remaining + rule[block_index]) else {
             return;
+        };
+        latest_starts[block_index] = latest_start;
+        space_for_remaining += rule[block_index] + 1;
+    }
+
+    // 配置済みブロックのスタック（各ブロックの開始位置と、そのブロックまでを配置したビットマスク）
+    let mut placed: Vec<(usize, LineMask)> = Vec::with_capacity(rule.len());
+    let mut start_index = 0; // 次のブロックを配置し始めることができる、最小のインデックス
+
+    loop {
+        // 現在配置しようとしているルールのインデックスと、現在の配置状態
+        let block_index = placed.len();
+        let mask = placed.last().map_or(0, |&(_, mask)| mask);
+
+        if block_index == rule.len() {
+            // 全てのルールブロックを配置し終えたら、現在の配置を解として保存
+            solutions.push(mask);
+        } else if start_index <= latest_starts[block_index] {
+            // まだ配置できる場所が残っていれば、ブロックのビットを立てて配置する
+            let block_length = rule[block_index];
+            placed.push((
+                start_index,
+                mask | range_mask(start_index, start_index + block_length),
+            ));
+            // 次のブロックは、現在のブロックの終わり+1マス空けた位置から開始できる
+            start_index += block_length + 1;
+            continue;
+        }
+
+        // バックトラック：直前に配置したブロックを取り除き、1マス右の配置場所を試す
+        // スタックが空になれば、全ての配置を試し終えたということ
+        let Some((last_start, _)) = placed.pop() else {
+            break;
+        };
+        start_index = last_start + 1;
+    }
+}
+
+/// 同じ長さのラインに対する、ルールごとの配置パターンのキャッシュ
+/// 大きな盤面では同じルールのラインが何度も現れるので、配置パターンの生成はルールごとに一度で済ませる
+/// 一つのラインにしか現れないルールはキャッシュしても再利用されず、メモリを余分に使うだけなので、
+/// 複数のラインに現れるルールだけをキャッシュする
+/// キャッシュは`solve_puzzle`の呼び出しごとに作り直すので、解析が終われば配置パターンのメモリは解放される
+struct PossibilityCache<'a> {
+    /// キャッシュ対象のラインの長さ
+    line_size: usize,
+    /// 複数のラインに現れる（キャッシュする）ルール
+    shared_rules: HashSet<&'a [usize]>,
+    /// ルールをキーとした、そのルールに合致する全ての配置パターン
+    possibilities: RefCell<HashMap<&'a [usize], Vec<LineMask>>>,
+}
+
+impl<'a> PossibilityCache<'a> {
+    /// 同じ長さのライン全体のルールから、複数のラインに現れるルールを数えておく
+    /// ルールだけで全てのマスが決まるラインは列挙されないので数えない
+    fn new(line_size: usize, infos: &[LineInfo<'a>]) -> Self {
+        let mut counts: HashMap<&'a [usize], usize> = HashMap::new();
+        for info in infos.iter().filter(|info| info.forced.is_none()) {
+            *counts.entry(info.rule).or_insert(0) += 1;
+        }
+        PossibilityCache {
+            line_size,
+            shared_rules: counts
+                .into_iter()
+                .filter(|&(_, count)| count >= 2)
+                .map(|(rule, _)| rule)
+                .collect(),
+            possibilities: RefCell::new(HashMap::new()),
         }
+    }
 
-        // これから配置するブロックの長さ
-        let block_length = rule[block_index];
-        // このブロックより後に続くブロックが必要とする最小スペース（ブロック長 + 区切りの1マス）
-        let space_for_remaining: usize = if block_index + 1 < rule.len() {
-            rule[block_index + 1..].iter().sum::<usize>() + (rule.len() - 1 - block_index)
+    /// ルールに合致する全ての配置パターンを`patterns`の末尾に追加し、その範囲を返す
+    /// 複数のラインに現れるルールは初めての時に生成してキャッシュし、以後はキャッシュから複製する
+    /// それ以外のルールはキャッシュせず、`patterns`に直接生成する
+    /// 呼び出し側は追加した配置パターンをそのラインの候補として絞り込んでいく
+    fn append_to(&self, rule: &'a [usize], patterns: &mut Vec<LineMask>) -> Candidates {
+        let start = patterns.len();
+        if self.shared_rules.contains(rule) {
+            let mut possibilities = self.possibilities.borrow_mut();
+            if let Some(possibilities) = possibilities.get(rule) {
+                patterns.extend_from_slice(possibilities);
+            } else {
+                generate_possibilities(self.line_size, rule, patterns);
+                possibilities.insert(rule, patterns[start..].to_vec());
+            }
         } else {
-            0
+            generate_possibilities(self.line_size, rule, patterns);
+        }
+        let len = patterns.len() - start;
+        Candidates {
+            start,
+            len,
+            live: len,
+        }
+    }
+}
+
+/// 仮置きを取り消せるように記録しておく、解析中の状態の変更
+enum TrailEntry {
+    /// マスが確定した（取り消す際は「空」に戻す）
+    Cell(usize, usize),
+    /// ラインの有効な候補の数が減った（取り消す際は記録しておいた数に戻す）
+    Candidates(Line, usize),
+}
+
+/// 解析中の盤面と、各ラインの候補や解析待ちのキューをまとめた構造体
+struct Solver<'a> {
+    rows: usize,
+    cols: usize,
+    /// 各行・各列の長さやルール
+    row_infos: &'a [LineInfo<'a>],
+    col_infos: &'a [LineInfo<'a>],
+    /// 行（長さ`cols`）と列（長さ`rows`）それぞれの配置パターンのキャッシュ
+    row_cache: &'a PossibilityCache<'a>,
+    col_cache: &'a PossibilityCache<'a>,
+    /// 全マスを1つの連続した配列に並べた盤面（`r`行`c`列のマスは`board[r * cols + c]`）
+    board: Vec<CellState>,
+    /// 盤面の各行・各列を「塗り」のマスクと確定済みのマスクで表したもの
+    /// 盤面を書き換えるたびに行と列の両方を更新しておくことで、ラインを解析するたびに盤面から読み出さずに済む
+    row_filled: Vec<LineMask>,
+    row_known: Vec<LineMask>,
+    col_filled: Vec<LineMask>,
+    col_known: Vec<LineMask>,
+    /// 各行・各列でまだ矛盾していない配置パターン（配置パターンの列挙が必要になるまでは`None`）
+    row_candidates: Vec<Option<Candidates>>,
+    col_candidates: Vec<Option<Candidates>>,
+    /// 全ラインの配置パターンをまとめた配列（各ラインの範囲は`Candidates`が持つ）
+    patterns: Vec<LineMask>,
+    /// 解析待ちのライン（残っている候補が少ないラインから先に取り出す）
+    queue: BinaryHeap<Reverse<(usize, Line)>>,
+    /// 同じラインを重複してキューに入れないよう、キューに入っている行と列を記録しておく
+    queued_rows: Vec<bool>,
+    queued_cols: Vec<bool>,
+    /// ルールだけで全てのマスが決まり、解析の最初に書き込み済みの行と列（以後はキューに入れない）
+    done_rows: Vec<bool>,
+    done_cols: Vec<bool>,
+    /// 仮置きを取り消すための、状態の変更の記録
+    /// 仮置きのたびに盤面や候補を丸ごと複製する代わりに、変更された箇所だけを記録して逆順に戻す
+    trail: Vec<TrailEntry>,
+    /// これまでに行ったラインの解析の回数（仮置きにかける手間を数えるのに使う）
+    line_solves: usize,
+    /// 仮置きを試しているマス（仮置き中でなければ`None`）
+    probing_cell: Option<usize>,
+    /// 各行・各列について、仮置き中にそのラインを解析したマスの一覧
+    /// 仮置きの結果はそこで解析したラインの状態だけで決まるので、ラインのマスが確定したときはこの一覧のマスだけを試し直せばよい
+    row_watchers: Vec<Vec<usize>>,
+    col_watchers: Vec<Vec<usize>>,
+}
+
+impl<'a> Solver<'a> {
+    /// ルールと呼び出し時点の盤面から、解析前の状態を作る（解析を始めるには`seed`を呼ぶ）
+    fn new(
+        rows: usize,
+        cols: usize,
+        row_infos: &'a [LineInfo<'a>],
+        col_infos: &'a [LineInfo<'a>],
+        row_cache: &'a PossibilityCache<'a>,
+        col_cache: &'a PossibilityCache<'a>,
+        initial_grid: &[Vec<CellState>],
+    ) -> Self {
+        let mut solver = Solver {
+            rows,
+            cols,
+            row_infos,
+            col_infos,
+            row_cache,
+            col_cache,
+            board: vec![CellState::Empty; rows * cols],
+            row_filled: vec![0; rows],
+            row_known: vec![0; rows],
+            col_filled: vec![0; cols],
+            col_known: vec![0; cols],
+            row_candidates: (0..rows).map(|_| None).collect(),
+            col_candidates: (0..cols).map(|_| None).collect(),
+            patterns: Vec::new(),
+            queue: BinaryHeap::new(),
+            queued_rows: vec![false; rows],
+            queued_cols: vec![false; cols],
+            done_rows: vec![false; rows],
+            done_cols: vec![false; cols],
+            trail: Vec::new(),
+            line_solves: 0,
+            probing_cell: None,
+            row_watchers: vec![Vec::new(); rows],
+            col_watchers: vec![Vec::new(); cols],
         };
-        // 現在のブロックを配置できる、最も遅い（右側の）開始位置
-        let latest_start = size - space_for_remaining - block_length;
-
-        // 再帰ステップ: start_indexからlatest_startまで、ブロックを配置できる全ての場所を試す
-        for i in start_index..=latest_start {
-            // ブロックを配置する（1で埋める）
-            for j in 0..block_length {
-                current_arrangement[i + j] = 1;
+        for (r, row) in initial_grid.iter().enumerate() {
+            for (c, &state) in row.iter().enumerate() {
+                if state != CellState::Empty {
+                    solver.write_cell(r, c, state);
+                }
+            }
+        }
+        solver
+    }
+
+    /// 未確定のマスに状態を書き込み、そのマスを含む行と列のマスクも更新する
+    fn write_cell(&mut self, r: usize, c: usize, state: CellState) {
+        self.trail.push(TrailEntry::Cell(r, c));
+        self.board[r * self.cols + c] = state;
+        self.row_known[r] |= 1 << c;
+        self.col_known[c] |= 1 << r;
+        if state == CellState::Filled {
+            self.row_filled[r] |= 1 << c;
+            self.col_filled[c] |= 1 << r;
+        }
+    }
+
+    /// ルールだけで全てのマスが決まるラインを盤面に書き込んだ上で、残りの全ての行と列をキューに入れる
+    /// 書き込んだラインは以後変化しないので、解析の対象から外す
+    ///
+    /// # Returns
+    /// * `Ok(())` - 解析を始められる状態になった
+    /// * `Err(Line)` - 呼び出し時点の盤面と矛盾するライン
+    fn seed(&mut self) -> Result<(), Line> {
+        for r in 0..self.rows {
+            if let Some(pattern) = self.row_infos[r].forced {
+                if (pattern ^ self.row_filled[r]) & self.row_known[r] != 0 {
+                    return Err(Line::Row(r));
+                }
+                let mut unknown = self.row_infos[r].full_mask & !self.row_known[r];
+                while unknown != 0 {
+                    let c = unknown.trailing_zeros() as usize;
+                    unknown &= unknown - 1;
+                    self.write_cell(r, c, cell_state_at(pattern, c));
+                }
+                self.done_rows[r] = true;
             }
+        }
+        for c in 0..self.cols {
+            if let Some(pattern) = self.col_infos[c].forced {
+                if (pattern ^ self.col_filled[c]) & self.col_known[c] != 0 {
+                    return Err(Line::Col(c));
+                }
+                let mut unknown = self.col_infos[c].full_mask & !self.col_known[c];
+                while unknown != 0 {
+                    let r = unknown.trailing_zeros() as usize;
+                    unknown &= unknown - 1;
+                    self.write_cell(r, c, cell_state_at(pattern, r));
+                }
+                self.done_cols[c] = true;
+            }
+        }
 
-            // 次のブロックを配置するために再帰呼び出し
-            // 次のブロックは、現在のブロックの終わり+1マス空けた位置から開始できる
-            let next_start = i + block_length + 1;
-            recurse(
-                size,
-                rule,
-                block_index + 1,
-                next_start,
-                current_arrangement,
-                solutions,
-            );
+        // 残りの全ての行と列をキューに入れ、以後はマスが確定したときにそのマスと交差するラインだけを追加する
+        // 残っている候補が少ないラインほど解析が軽く、マスも確定しやすいので、候補数の少ないラインから先に取り出す
+        // 配置パターンをまだ列挙していないラインは、軽い左詰めと右詰めの比較で解析できるので最優先とする
+        for r in 0..self.rows {
+            self.enqueue_row(r);
+        }
+        for c in 0..self.cols {
+            self.enqueue_col(c);
+        }
+        Ok(())
+    }
+
+    /// 行をキューに追加する（既にキューに入っているか、解析の対象から外した行であれば何もしない）
+    fn enqueue_row(&mut self, r: usize) {
+        if !self.queued_rows[r] && !self.done_rows[r] {
+            self.queued_rows[r] = true;
+            let count = self.row_candidates[r].as_ref().map_or(0, |c| c.live);
+            self.queue.push(Reverse((count, Line::Row(r))));
+        }
+    }
+
+    /// 列をキューに追加する（既にキューに入っているか、解析の対象から外した列であれば何もしない）
+    fn enqueue_col(&mut self, c: usize) {
+        if !self.queued_cols[c] && !self.done_cols[c] {
+            self.queued_cols[c] = true;
+            let count = self.col_candidates[c].as_ref().map_or(0, |c| c.live);
+            self.queue.push(Reverse((count, Line::Col(c))));
+        }
+    }
+
+    /// マスの状態を書き込み、そのマスを含む行と列をキューに追加する
+    fn set_cell(&mut self, r: usize, c: usize, state: CellState) {
+        self.write_cell(r, c, state);
+        self.enqueue_row(r);
+        self.enqueue_col(c);
+    }
 
-            // バックトラック：配置したブロックを元に戻し（0で埋める）、次の配置場所を試す
-            for j in 0..block_length {
-                current_arrangement[i + j] = 0;
+    /// ラインの有効な候補の数が解析前の`live_before`から減っていれば、取り消せるように記録する
+    /// 解析中に初めて候補を列挙した場合は、全ての候補が有効な状態を解析前の状態とみなす
+    fn record_candidates(&mut self, line: Line, live_before: Option<usize>) {
+        let candidates = match line {
+            Line::Row(r) => &self.row_candidates[r],
+            Line::Col(c) => &self.col_candidates[c],
+        };
+        if let Some(candidates) = candidates {
+            let live_before = live_before.unwrap_or(candidates.len);
+            if candidates.live != live_before {
+                self.trail.push(TrailEntry::Candidates(line, live_before));
             }
         }
     }
 
-    // ルールが空または[0]の場合、すべて0のパターンのみが解となる
-    if rule.is_empty() || (rule.len() == 1 && rule[0] == 0) {
-        solutions.push(vec![0; size]);
-    } else {
-        // 再帰処理を開始
-        recurse(size, rule, 0, 0, &mut current_arrangement, &mut solutions);
+    /// 記録の長さが`mark`に戻るまで、状態の変更を新しいものから順に取り消す
+    /// 解析の途中で矛盾が見つかった場合に備えて、解析待ちのキューも空にしておく
+    fn undo(&mut self, mark: usize) {
+        while self.trail.len() > mark {
+            match self.trail.pop() {
+                Some(TrailEntry::Cell(r, c)) => {
+                    self.board[r * self.cols + c] = CellState::Empty;
+                    self.row_filled[r] &= !(1 << c);
+                    self.row_known[r] &= !(1 << c);
+                    self.col_filled[c] &= !(1 << r);
+                    self.col_known[c] &= !(1 << r);
+                }
+                Some(TrailEntry::Candidates(line, live)) => {
+                    let candidates = match line {
+                        Line::Row(r) => &mut self.row_candidates[r],
+                        Line::Col(c) => &mut self.col_candidates[c],
+                    };
+                    if let Some(candidates) = candidates {
+                        candidates.live = live;
+                    }
+                }
+                None => break,
+            }
+        }
+        while let Some(Reverse((_, line))) = self.queue.pop() {
+            match line {
+                Line::Row(r) => self.queued_rows[r] = false,
+                Line::Col(c) => self.queued_cols[c] = false,
+            }
+        }
     }
-    solutions
-}
 
-/// グリッド（2次元ベクトル）の行と列を入れ替える（転置する）ヘルパー関数
-/// これにより、行を解析する`solve_line`関数を、列の解析にもそのまま再利用できる
-fn transpose(grid: Vec<Vec<CellState>>) -> Vec<Vec<CellState>> {
-    if grid.is_empty() {
-        return Vec::new();
+    /// キューが空になるまでラインの解析を繰り返し、確定できるマスを全て盤面に書き込む
+    ///
+    /// # Returns
+    /// * `Ok(())` - これ以上確定できるマスがなくなった
+    /// * `Err(Line)` - 矛盾が見つかったライン
+    ///
+    /// 仮置き中は矛盾が頻繁に見つかるので、ここではエラーメッセージを作らず、
+    /// ユーザーに結果を返す`solve_puzzle`でだけメッセージを組み立てる
+    fn propagate(&mut self) -> Result<(), Line> {
+        while let Some(Reverse((_, line))) = self.queue.pop() {
+            self.line_solves += 1;
+            // 仮置き中であれば、仮置きしたマスがこのラインの状態に依存することを記録する
+            if let Some(index) = self.probing_cell {
+                let watchers = match line {
+                    Line::Row(r) => &mut self.row_watchers[r],
+                    Line::Col(c) => &mut self.col_watchers[c],
+                };
+                if watchers.last() != Some(&index) {
+                    watchers.push(index);
+                }
+            }
+            match line {
+                // 行を解析する
+                Line::Row(r) => {
+                    self.queued_rows[r] = false;
+                    let live_before = self.row_candidates[r].as_ref().map(|c| c.live);
+                    let solved = solve_line(
+                        self.row_cache,
+                        &self.row_infos[r],
+                        &mut self.row_candidates[r],
+                        &mut self.patterns,
+                        self.row_filled[r],
+                        self.row_known[r],
+                    );
+                    self.record_candidates(line, live_before);
+                    let (new_filled, new_known, revisit) = solved.ok_or(line)?;
+                    // 新たに確定したマスだけを盤面に書き込み、そのマスを含む列をキューに追加する
+                    let mut newly_known = new_known & !self.row_known[r];
+                    while newly_known != 0 {
+                        let c = newly_known.trailing_zeros() as usize;
+                        newly_known &= newly_known - 1;
+                        self.write_cell(r, c, cell_state_at(new_filled, c));
+                        self.enqueue_col(c);
+                    }
+                    if revisit {
+                        self.enqueue_row(r);
+                    }
+                }
+                // 列を解析する
+                // 列のマスクは盤面と一緒に更新されているので、行と同じように盤面を読み出さずに解析できる
+                Line::Col(c) => {
+                    self.queued_cols[c] = false;
+                    let live_before = self.col_candidates[c].as_ref().map(|c| c.live);
+                    let solved = solve_line(
+                        self.col_cache,
+                        &self.col_infos[c],
+                        &mut self.col_candidates[c],
+                        &mut self.patterns,
+                        self.col_filled[c],
+                        self.col_known[c],
+                    );
+                    self.record_candidates(line, live_before);
+                    let (new_filled, new_known, revisit) = solved.ok_or(line)?;
+                    // 新たに確定したマスだけを盤面に書き込み、そのマスを含む行をキューに追加する
+                    let mut newly_known = new_known & !self.col_known[c];
+                    while newly_known != 0 {
+                        let r = newly_known.trailing_zeros() as usize;
+                        newly_known &= newly_known - 1;
+                        self.write_cell(r, c, cell_state_at(new_filled, r));
+                        self.enqueue_row(r);
+                    }
+                    if revisit {
+                        self.enqueue_col(c);
+                    }
+                }
+            }
+        }
+        Ok(())
     }
-    let rows = grid.len();
-    let cols = grid[0].len();
-    let mut transposed = vec![vec![CellState::Empty; rows]; cols];
-    for r in 0..rows {
-        for c in 0..cols {
-            transposed[c][r] = grid[r][c];
+
+    /// ラインごとの解析だけでは確定できないマスを、仮置きによって確定させる
+    /// 未確定のマスを仮に「塗り」や「×」にして解析を進め、矛盾が出れば、そのマスは反対の状態で確定する
+    /// マスが確定するたびに盤面全体を調べ直す代わりに、確定したマスを含む行と列を仮置き中に解析したマスだけを
+    /// 作業リストの先頭に入れ直し、作業リストが空になるか、手間の上限(`PROBE_LINE_BUDGET`)に達するまで繰り返す
+    ///
+    /// # Returns
+    /// * `Ok(())` - これ以上確定できるマスがなくなった（または手間の上限に達した）
+    /// * `Err(Line)` - 矛盾が見つかったライン
+    fn probe(&mut self) -> Result<(), Line> {
+        // 仮置き前の解析で確定した状態は取り消す必要がないので、記録は捨ててよい
+        self.trail.clear();
+        let line_solves_limit = self.line_solves + PROBE_LINE_BUDGET;
+
+        // 仮置きを試すマスの作業リスト（最初は全ての未確定のマス）
+        let mut pending: VecDeque<usize> = (0..self.rows * self.cols)
+            .filter(|&index| self.board[index] == CellState::Empty)
+            .collect();
+        let mut in_pending = vec![false; self.rows * self.cols];
+        for &index in &pending {
+            in_pending[index] = true;
+        }
+
+        while let Some(index) = pending.pop_front() {
+            in_pending[index] = false;
+            if self.board[index] != CellState::Empty {
+                continue;
+            }
+            // 手間の上限に達したら、それまでに確定したマスだけを結果とする
+            if self.line_solves >= line_solves_limit {
+                return Ok(());
+            }
+            let (r, c) = (index / self.cols, index % self.cols);
+            for (trial, opposite) in [
+                (CellState::Filled, CellState::Crossed),
+                (CellState::Crossed, CellState::Filled),
+            ] {
+                // 仮置きして解析を進めてみた後、記録を使って仮置き前の状態に戻す
+                let mark = self.trail.len();
+                self.probing_cell = Some(index);
+                self.set_cell(r, c, trial);
+                let contradicted = self.propagate().is_err();
+                self.probing_cell = None;
+                self.undo(mark);
+                if contradicted {
+                    // 仮置きで矛盾が出たので、反対の状態で確定させて解析を進める
+                    self.set_cell(r, c, opposite);
+                    self.propagate()?;
+
+                    // 確定したマスを含む行と列を解析したマスは、仮置きの結果が変わりうるので試し直す
+                    // そのうち確定したマスと同じ行か列にあるマスは、新たに確定できる見込みが高いので作業リストの先頭に入れる
+                    for entry in &self.trail {
+                        let TrailEntry::Cell(r2, c2) = *entry else {
+                            continue;
+                        };
+                        let watchers = std::mem::take(&mut self.row_watchers[r2])
+                            .into_iter()
+                            .chain(std::mem::take(&mut self.col_watchers[c2]));
+                        for watcher in watchers {
+                            if self.board[watcher] == CellState::Empty && !in_pending[watcher] {
+                                in_pending[watcher] = true;
+                                if watcher / self.cols == r2 || watcher % self.cols == c2 {
+                                    pending.push_front(watcher);
+                                } else {
+                                    pending.push_back(watcher);
+                                }
+                            }
+                        }
+                    }
+
+                    // 確定した状態は取り消す必要がないので、記録は捨ててよい
+                    self.trail.clear();
+                    break;
+                }
+            }
         }
+        Ok(())
     }
-    transposed
 }
 
 /// JavaScriptから呼び出されるメインの関数パズル全体の解析を行う
@@ -281,94 +996,505 @@ pub fn solve_puzzle(
     // 1. JavaScriptから渡されたJsValueを、Rustのデータ構造に変換（デシリアライズ）する
     let row_rules: Vec<Vec<usize>> = serde_wasm_bindgen::from_value(row_rules_js)?;
     let col_rules: Vec<Vec<usize>> = serde_wasm_bindgen::from_value(col_rules_js)?;
-    let mut current_grid: Vec<Vec<CellState>> = serde_wasm_bindgen::from_value(initial_grid_js)?;
+    let initial_grid: Vec<Vec<CellState>> = serde_wasm_bindgen::from_value(initial_grid_js)?;
 
-    // 呼び出し時点の盤面を、後で比較するために保存しておく
-    let original_grid = current_grid.clone();
-    // 無限ループを防ぐための最大反復回数を設定
-    let max_iterations = (rows + cols) * 2;
-    let mut iteration = 0;
+    // ビットマスクに収まらない大きさの盤面は扱えない
+    if rows > MAX_LINE_SIZE || cols > MAX_LINE_SIZE {
+        let result = SolveResult {
+            grid: initial_grid,
+            message: format!("盤面の大きさは{}マスまでです", MAX_LINE_SIZE),
+            error: true,
+        };
+        return Ok(serde_wasm_bindgen::to_value(&result)?);
+    }
 
-    // 2. メインの解析ループ盤面に変化がなくなるまで繰り返す
-    loop {
-        let mut changed_in_this_iteration = false;
-
-        // ステップA: 全ての行を解析する
-        for r in 0..rows {
-            match solve_line(cols, &row_rules[r], &current_grid[r]) {
-                Ok(new_line) => {
-                    // ラインに変化があれば、盤面を更新し、変更フラグを立てる
-                    if new_line != current_grid[r] {
-                        current_grid[r] = new_line;
-                        changed_in_this_iteration = true;
-                    }
-                }
-                // `solve_line`がエラーを返した場合、エラーメッセージを含んだ結果を返して即時終了
-                Err(e) => {
-                    let result = SolveResult {
-                        grid: original_grid,
-                        message: format!("行 {}: {}", r + 1, e),
-                        error: true,
-                    };
-                    return Ok(serde_wasm_bindgen::to_value(&result)?);
+    // 2. ラインごとの解析で確定できるマスを全て確定させ、それでも残ったマスは仮置きで確定させる
+    // 呼び出し時点の盤面(`initial_grid`)は複製せずにそのまま残し、エラー時にはそれを返す
+    let row_infos: Vec<LineInfo> = row_rules
+        .iter()
+        .map(|rule| LineInfo::new(cols, rule))
+        .collect();
+    let col_infos: Vec<LineInfo> = col_rules
+        .iter()
+        .map(|rule| LineInfo::new(rows, rule))
+        .collect();
+    let row_cache = PossibilityCache::new(cols, &row_infos);
+    let col_cache = PossibilityCache::new(rows, &col_infos);
+    let mut solver = Solver::new(
+        rows,
+        cols,
+        &row_infos,
+        &col_infos,
+        &row_cache,
+        &col_cache,
+        &initial_grid,
+    );
+    if let Err(line) = solver
+        .seed()
+        .and_then(|()| solver.propagate())
+        .and_then(|()| solver.probe())
+    {
+        let message = match line {
+            Line::Row(r) => format!("行 {}: 入力に矛盾があります", r + 1),
+            Line::Col(c) => format!("列 {}: 入力に矛盾があります", c + 1),
+        };
+        let result = SolveResult {
+            grid: initial_grid,
+            message,
+            error: true,
+        };
+        return Ok(serde_wasm_bindgen::to_value(&result)?);
+    }
+
+    // 3. これ以上確定できるマスがなくなったので解析は完了
+    let updated = solver.board.iter().ne(initial_grid.iter().flatten());
+    let message = if !updated {
+        // 呼び出し時点から何も変化がなければ、これ以上進展はない
+        "これ以上自動で確定できるマスはありません".to_string()
+    } else {
+        // 呼び出し時点から変化していれば、更新があったことを伝える
+        "確定できるマスを更新しました".to_string()
+    };
+    let result = SolveResult {
+        grid: (0..rows)
+            .map(|r| solver.board[r * cols..(r + 1) * cols].to_vec())
+            .collect(),
+        message,
+        error: false,
+    };
+    Ok(serde_wasm_bindgen::to_value(&result)?)
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// 長さ`max_length`以下のラインに収まる全てのルールを列挙する（空のルールと[0]も含む）
+    fn rules_within(max_length: usize) -> Vec<Vec<usize>> {
+        let mut rules = vec![vec![], vec![0]];
+        let mut stack: Vec<Vec<usize>> = (1..=max_length).map(|length| vec![length]).collect();
+        while let Some(rule) = stack.pop() {
+            let used = rule.iter().sum::<usize>() + rule.len() - 1;
+            for length in 1..max_length.saturating_sub(used) {
+                let mut longer = rule.clone();
+                longer.push(length);
+                stack.push(longer);
+            }
+            rules.push(rule);
+        }
+        rules
+    }
+
+    /// ライン上の全ての「塗り」と確定済みのマスの組み合わせ（「塗り」は確定済みのマスに含まれる）を列挙する
+    fn line_states(line_size: usize) -> Vec<(LineMask, LineMask)> {
+        let mut states = Vec::new();
+        for line_known in 0..1 << line_size {
+            let mut line_filled: LineMask = line_known;
+            loop {
+                states.push((line_filled, line_known));
+                if line_filled == 0 {
+                    break;
                 }
+                line_filled = (line_filled - 1) & line_known;
             }
         }
+        states
+    }
 
-        // ステップB: 全ての列を解析する
-        // グリッドを転置することで、`solve_line`を列解析に再利用する
-        let mut transposed = transpose(current_grid.clone());
-        for c in 0..cols {
-            match solve_line(rows, &col_rules[c], &transposed[c]) {
-                Ok(new_line) => {
-                    if new_line != transposed[c] {
-                        transposed[c] = new_line;
-                        changed_in_this_iteration = true;
-                    }
+    /// ラインごとの解析だけでは解き切れない盤面の解（1が「塗り」）
+    fn unfinished_solution() -> Vec<Vec<u8>> {
+        vec![
+            vec![1, 1, 0, 0, 1, 0, 1, 0],
+            vec![1, 0, 1, 0, 1, 1, 0, 0],
+            vec![0, 1, 1, 0, 0, 1, 0, 1],
+            vec![0, 0, 1, 1, 0, 1, 1, 0],
+            vec![1, 0, 0, 1, 1, 0, 1, 1],
+            vec![0, 1, 0, 1, 0, 0, 1, 0],
+            vec![1, 1, 0, 0, 1, 1, 0, 1],
+            vec![0, 0, 1, 0, 1, 0, 1, 1],
+        ]
+    }
+
+    /// 解（1が「塗り」）から、各行と各列のルールを求める
+    fn rules_of(solution: &[Vec<u8>]) -> (Vec<Vec<usize>>, Vec<Vec<usize>>) {
+        let blocks = |cells: &mut dyn Iterator<Item = u8>| -> Vec<usize> {
+            let mut rule = Vec::new();
+            let mut run = 0;
+            for cell in cells.chain([0]) {
+                if cell == 1 {
+                    run += 1;
+                } else if run > 0 {
+                    rule.push(run);
+                    run = 0;
                 }
-                Err(e) => {
-                    let result = SolveResult {
-                        grid: original_grid,
-                        message: format!("列 {}: {}", c + 1, e),
-                        error: true,
+            }
+            rule
+        };
+        let row_rules = solution
+            .iter()
+            .map(|row| blocks(&mut row.iter().copied()))
+            .collect();
+        let col_rules = (0..solution[0].len())
+            .map(|c| blocks(&mut solution.iter().map(|row| row[c])))
+            .collect();
+        (row_rules, col_rules)
+    }
+
+    /// `solve_puzzle`と同じ手順でソルバーを作り、`f`に渡す（解析は始めない）
+    fn with_solver<R>(
+        row_rules: &[Vec<usize>],
+        col_rules: &[Vec<usize>],
+        initial_grid: &[Vec<CellState>],
+        f: impl FnOnce(&mut Solver) -> R,
+    ) -> R {
+        let (rows, cols) = (row_rules.len(), col_rules.len());
+        let row_infos: Vec<LineInfo> = row_rules
+            .iter()
+            .map(|rule| LineInfo::new(cols, rule))
+            .collect();
+        let col_infos: Vec<LineInfo> = col_rules
+            .iter()
+            .map(|rule| LineInfo::new(rows, rule))
+            .collect();
+        let row_cache = PossibilityCache::new(cols, &row_infos);
+        let col_cache = PossibilityCache::new(rows, &col_infos);
+        let mut solver = Solver::new(
+            rows,
+            cols,
+            &row_infos,
+            &col_infos,
+            &row_cache,
+            &col_cache,
+            initial_grid,
+        );
+        f(&mut solver)
+    }
+
+    #[test]
+    fn push_line_agrees_with_enumeration() {
+        for line_size in 1..=7 {
+            let full_mask = full_line_mask(line_size);
+            // ラインに収まらないルールも、矛盾として扱われることを確かめる
+            for rule in rules_within(line_size + 2) {
+                let info = LineInfo::new(line_size, &rule);
+                let mut possibilities = Vec::new();
+                generate_possibilities(line_size, &rule, &mut possibilities);
+                for (line_filled, line_known) in line_states(line_size) {
+                    let survivors: Vec<LineMask> = possibilities
+                        .iter()
+                        .copied()
+                        .filter(|p| (p ^ line_filled) & line_known == 0)
+                        .collect();
+                    let pushed = push_line(&info, line_filled, line_known);
+                    assert_eq!(
+                        pushed.is_none(),
+                        survivors.is_empty(),
+                        "rule {:?}, size {}, filled {:b}, known {:b}",
+                        rule,
+                        line_size,
+                        line_filled,
+                        line_known
+                    );
+                    let Some((new_filled, new_known)) = pushed else {
+                        continue;
                     };
-                    return Ok(serde_wasm_bindgen::to_value(&result)?);
+
+                    // 確定済みのマスはそのまま残り、新たに確定したマスは全ての候補で同じ状態になっている
+                    let must_be_filled = survivors.iter().fold(full_mask, |mask, p| mask & p);
+                    let may_be_filled = survivors.iter().fold(0, |mask, p| mask | p);
+                    let decided = must_be_filled | (full_mask & !may_be_filled);
+                    assert_eq!(new_known & line_known, line_known);
+                    assert_eq!(new_filled & line_known, line_filled);
+                    assert_eq!(new_known & !decided & !line_known, 0);
+                    assert_eq!(new_filled & new_known & !line_known & !must_be_filled, 0);
+                    assert_eq!(new_filled & !new_known, 0);
                 }
             }
         }
-        // 解析が終わったら、再度転置して盤面を元の向きに戻す
-        current_grid = transpose(transposed);
+    }
 
-        // 3. ループの終了条件をチェック
-        iteration += 1;
+    #[test]
+    fn undo_restores_solver_state() {
+        let solution = unfinished_solution();
+        let (rows, cols) = (solution.len(), solution[0].len());
+        let (row_rules, col_rules) = rules_of(&solution);
+        let initial_grid = vec![vec![CellState::Empty; cols]; rows];
+        with_solver(&row_rules, &col_rules, &initial_grid, |solver| {
+            solver.seed().and_then(|()| solver.propagate()).unwrap();
+            solver.trail.clear();
 
-        // このイテレーションで盤面に何も変化がなかった場合、解析は完了
-        if !changed_in_this_iteration {
-            let message = if current_grid == original_grid {
-                // 呼び出し時点から何も変化がなければ、これ以上進展はない
-                "これ以上自動で確定できるマスはありません".to_string()
-            } else {
-                // 呼び出し時点から変化していれば、更新があったことを伝える
-                "確定できるマスを更新しました".to_string()
+            // 盤面と4つのマスク、各ラインの有効な候補（順序は問わない）を控える
+            // 仮置き中に初めて列挙されたラインは、取り消した後も全ての配置パターンを候補として持つ
+            let live_candidates = |solver: &Solver| -> Vec<Option<Vec<LineMask>>> {
+                solver
+                    .row_candidates
+                    .iter()
+                    .chain(&solver.col_candidates)
+                    .map(|candidates| {
+                        candidates
+                            .as_ref()
+                            .filter(|candidates| candidates.live != candidates.len)
+                            .map(|candidates| {
+                                let mut live = solver.patterns
+                                    [candidates.start..candidates.start + candidates.live]
+                                    .to_vec();
+                                live.sort_unstable();
+                                live
+                            })
+                    })
+                    .collect()
             };
-            let result = SolveResult {
-                grid: current_grid,
-                message,
-                error: false,
+            let snapshot = |solver: &Solver| {
+                (
+                    solver.board.clone(),
+                    solver.row_filled.clone(),
+                    solver.row_known.clone(),
+                    solver.col_filled.clone(),
+                    solver.col_known.clone(),
+                    live_candidates(solver),
+                )
             };
-            return Ok(serde_wasm_bindgen::to_value(&result)?);
+            let before = snapshot(solver);
+
+            let mut candidates_restored = false;
+            for index in 0..rows * cols {
+                if solver.board[index] != CellState::Empty {
+                    continue;
+                }
+                for trial in [CellState::Filled, CellState::Crossed] {
+                    let mark = solver.trail.len();
+                    solver.set_cell(index / cols, index % cols, trial);
+                    let _ = solver.propagate();
+                    candidates_restored |= solver.trail[mark..]
+                        .iter()
+                        .any(|entry| matches!(entry, TrailEntry::Candidates(..)));
+                    solver.undo(mark);
+                    assert_eq!(solver.trail.len(), mark);
+                    assert!(solver.queue.is_empty());
+                    assert_eq!(
+                        snapshot(solver),
+                        before,
+                        "cell {}, trial {:?}",
+                        index,
+                        trial
+                    );
+                }
+            }
+            // 候補の絞り込みの取り消しも確かめられていること
+            assert!(candidates_restored);
+        });
+    }
+
+    #[test]
+    fn probe_work_is_bounded() {
+        // 全ての行と列のルールが[1]の盤面は、ラインごとの解析でも仮置きでも1マスも確定しない
+        // 手間の上限がなければ、全てのマスの仮置きに数秒かかる
+        let size = 100;
+        let rules = vec![vec![1]; size];
+        let initial_grid = vec![vec![CellState::Empty; size]; size];
+        with_solver(&rules, &rules, &initial_grid, |solver| {
+            solver.seed().and_then(|()| solver.propagate()).unwrap();
+            let line_solves = solver.line_solves;
+            solver.probe().unwrap();
+            assert!(solver.board.iter().all(|&cell| cell == CellState::Empty));
+            // 上限を超えるのは、上限に達する直前のマスの仮置きの分だけ
+            assert!(solver.line_solves - line_solves <= PROBE_LINE_BUDGET + 4 * (size + size));
+        });
+    }
+
+    /// `seed`、`propagate`、`probe`の順に解析し、仮置きの前後の盤面を返す
+    fn propagate_and_probe(
+        row_rules: &[Vec<usize>],
+        col_rules: &[Vec<usize>],
+        initial_grid: &[Vec<CellState>],
+    ) -> Result<(Vec<CellState>, Vec<CellState>), Line> {
+        with_solver(row_rules, col_rules, initial_grid, |solver| {
+            solver.seed()?;
+            solver.propagate()?;
+            let propagated = solver.board.clone();
+            solver.probe()?;
+            Ok((propagated, solver.board.clone()))
+        })
+    }
+
+    /// 盤面のうち確定したマスが、全て解と一致しているかどうか
+    fn agrees_with(board: &[CellState], solution: &[Vec<u8>]) -> bool {
+        board
+            .iter()
+            .zip(solution.iter().flatten())
+            .all(|(&cell, &solved)| match cell {
+                CellState::Empty => true,
+                CellState::Filled => solved == 1,
+                CellState::Crossed => solved == 0,
+            })
+    }
+
+    #[test]
+    fn probe_decides_cells_beyond_propagation() {
+        let solution = unfinished_solution();
+        let (row_rules, col_rules) = rules_of(&solution);
+        let initial_grid = vec![vec![CellState::Empty; col_rules.len()]; row_rules.len()];
+        let (propagated, probed) =
+            propagate_and_probe(&row_rules, &col_rules, &initial_grid).unwrap();
+
+        let decided = |board: &[CellState]| {
+            board
+                .iter()
+                .filter(|&&cell| cell != CellState::Empty)
+                .count()
+        };
+        assert!(decided(&probed) > decided(&propagated));
+        assert!(agrees_with(&probed, &solution));
+    }
+
+    #[test]
+    fn probe_is_sound_on_random_boards() {
+        // 乱数で作った解と、その解から一部のマスを書き込んだ盤面で、仮置きが解と食い違うマスを確定させないことを確かめる
+        let mut state: u64 = 0x9e37_79b9_7f4a_7c15;
+        let mut next = move || {
+            state ^= state << 13;
+            state ^= state >> 7;
+            state ^= state << 17;
+            state
+        };
+        for _ in 0..300 {
+            let rows = 1 + (next() % 8) as usize;
+            let cols = 1 + (next() % 8) as usize;
+            let solution: Vec<Vec<u8>> = (0..rows)
+                .map(|_| (0..cols).map(|_| (next() % 2) as u8).collect())
+                .collect();
+            let (row_rules, col_rules) = rules_of(&solution);
+            let initial_grid: Vec<Vec<CellState>> = solution
+                .iter()
+                .map(|row| {
+                    row.iter()
+                        .map(|&solved| match (next() % 8, solved) {
+                            (0, 1) => CellState::Filled,
+                            (0, _) => CellState::Crossed,
+                            _ => CellState::Empty,
+                        })
+                        .collect()
+                })
+                .collect();
+            let (_, probed) = propagate_and_probe(&row_rules, &col_rules, &initial_grid)
+                .expect("解と一致する盤面で矛盾が見つかった");
+            assert!(
+                agrees_with(&probed, &solution),
+                "rows {:?}, cols {:?}",
+                row_rules,
+                col_rules
+            );
         }
+    }
 
-        // 最大反復回数に達した場合、エラーとして終了
-        if iteration >= max_iterations {
-            let result = SolveResult {
-                grid: current_grid,
-                message:
-                    "反復回数が上限に達しましたロジックが複雑すぎるか、矛盾があるかもしれません"
-                        .to_string(),
-                error: true,
-            };
-            return Ok(serde_wasm_bindgen::to_value(&result)?);
+    #[test]
+    fn seed_writes_forced_lines() {
+        use CellState::{Crossed as X, Empty as E, Filled as F};
+        // 空のルールと[0]の行は全て「×」、[2, 1]の行はちょうど収まるので「塗り」「塗り」「×」「塗り」で確定する
+        // 列のうち[0]の列も全て「×」で確定し、それ以外の列はルールだけでは決まらない
+        let row_rules = vec![vec![], vec![0], vec![2, 1]];
+        let col_rules = vec![vec![1], vec![1], vec![0], vec![1]];
+        let initial_grid = vec![vec![E; 4]; 3];
+        with_solver(&row_rules, &col_rules, &initial_grid, |solver| {
+            solver.seed().unwrap();
+            assert_eq!(solver.board, [X, X, X, X, X, X, X, X, F, F, X, F]);
+            // 確定させたラインは解析の対象から外し、残りのラインだけをキューに入れる
+            assert_eq!(solver.done_rows, [true, true, true]);
+            assert_eq!(solver.done_cols, [false, false, true, false]);
+            assert_eq!(solver.queued_rows, [false, false, false]);
+            assert_eq!(solver.queued_cols, [true, true, false, true]);
+            // マスが確定しても、解析の対象から外したラインはキューに入らない
+            solver.enqueue_row(0);
+            solver.enqueue_col(2);
+            assert_eq!(solver.queue.len(), 3);
+            solver.propagate().unwrap();
+        });
+    }
+
+    #[test]
+    fn seed_reports_conflicts() {
+        use CellState::{Empty as E, Filled as F};
+        // 空のルールの行に「塗り」が書き込まれている
+        let initial_grid = vec![vec![E, E], vec![E, F]];
+        let result = with_solver(
+            &[vec![1], vec![]],
+            &[vec![1], vec![1]],
+            &initial_grid,
+            |solver| solver.seed(),
+        );
+        assert_eq!(result, Err(Line::Row(1)));
+
+        // 行のルールで決まるマスと、列のルールで決まるマスが食い違う
+        let initial_grid = vec![vec![E, E]];
+        let result = with_solver(&[vec![2]], &[vec![0], vec![1]], &initial_grid, |solver| {
+            solver.seed()
+        });
+        assert_eq!(result, Err(Line::Col(0)));
+    }
+
+    #[test]
+    fn cache_returns_generated_patterns() {
+        // [1, 1]と[2]は複数の行に現れるのでキャッシュし、[3]と、ルールだけで決まる[2, 2]はキャッシュしない
+        let line_size = 5;
+        let rules = vec![
+            vec![1, 1],
+            vec![2],
+            vec![1, 1],
+            vec![3],
+            vec![2],
+            vec![2, 2],
+            vec![2, 2],
+        ];
+        let infos: Vec<LineInfo> = rules
+            .iter()
+            .map(|rule| LineInfo::new(line_size, rule))
+            .collect();
+        let cache = PossibilityCache::new(line_size, &infos);
+        let mut shared_rules: Vec<&[usize]> = cache.shared_rules.iter().copied().collect();
+        shared_rules.sort();
+        assert_eq!(shared_rules, [&[1, 1][..], &[2][..]]);
+
+        // キャッシュから複製した場合も直接生成した場合も、同じ配置パターンを返す
+        let mut patterns = Vec::new();
+        for rule in &rules {
+            let candidates = cache.append_to(rule, &mut patterns);
+            assert_eq!(candidates.live, candidates.len);
+            let mut expected = Vec::new();
+            generate_possibilities(line_size, rule, &mut expected);
+            assert_eq!(
+                patterns[candidates.start..candidates.start + candidates.len],
+                expected[..]
+            );
+        }
+        assert_eq!(patterns.len(), 6 + 4 + 6 + 3 + 4 + 1 + 1);
+        assert_eq!(cache.possibilities.borrow().len(), 2);
+    }
+
+    #[test]
+    fn generator_matches_brute_force() {
+        for line_size in 0..=8 {
+            // ラインに収まらないルールも含めて、全てのマスの塗り方から求めたパターンと一致すること
+            for rule in rules_within(line_size + 2) {
+                let mut generated = Vec::new();
+                generate_possibilities(line_size, &rule, &mut generated);
+                let normalized: &[usize] = if rule == [0] { &[] } else { &rule };
+                let expected: Vec<LineMask> = (0..1 << line_size)
+                    .filter(|&mask: &LineMask| {
+                        let cells: Vec<u8> =
+                            (0..line_size).map(|i| (mask >> i & 1) as u8).collect();
+                        rules_of(&[cells]).0[0] == normalized
+                    })
+                    .collect();
+                generated.sort_unstable();
+                assert_eq!(generated, expected, "rule {:?}, size {}", rule, line_size);
+            }
         }
+
+        // ルールがラインに収まらない場合は、配置パターンは一つもない
+        let mut generated = Vec::new();
+        generate_possibilities(4, &[2, 2], &mut generated);
+        generate_possibilities(4, &[5], &mut generated);
+        generate_possibilities(0, &[1], &mut generated);
+        assert!(generated.is_empty());
     }
 }